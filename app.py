@@ -1,69 +1,359 @@
 import streamlit as st
 import chromadb
-from chromadb.utils import embedding_functions
 from openai import OpenAI
+from concurrent.futures import ThreadPoolExecutor
 import os
+import re
 from dotenv import load_dotenv
 import json
 
 load_dotenv()
 
-# Initialize
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Initialize clients once per server process, not on every rerun
+@st.cache_resource(show_spinner=False)
+def get_openai_client():
+    """Shared OpenAI client"""
+    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
-openai_ef = embedding_functions.OpenAIEmbeddingFunction(
-    api_key=os.getenv("OPENAI_API_KEY"),
-    model_name="text-embedding-3-small"
-)
+client = get_openai_client()
 
-chroma_client = chromadb.PersistentClient(path="./chroma_db")
-collection = chroma_client.get_collection(
-    name="scientific_papers",
-    embedding_function=openai_ef
-)
+# Concurrent GPT calls when extracting every result with its own prompt
+EXTRACTION_WORKERS = 8
+EXCERPT_MAX_CHARS = 4000  # Room for a full 800-token chunk in extraction prompts
 
-def extract_structured_data(text_chunk, query):
-    """Extract structured fields using GPT-4"""
-    
-    prompt = f"""You are analyzing a scientific research document excerpt.
+# Queries are embedded here, with the same model used at ingest
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 512  # Shortened from the model's native 1536
+# Vectors of different sizes can't share a collection, so the name carries the size
+COLLECTION_NAME = f"scientific_papers_{EMBEDDING_DIMENSIONS}"
 
-Query: {query}
+# Query expansion: rephrasings searched alongside the query, merged by reciprocal rank
+EXPANSION_SCHEMA = {
+    "type": "object",
+    "properties": {"queries": {"type": "array", "items": {"type": "string"}}},
+    "required": ["queries"],
+    "additionalProperties": False
+}
+RRF_K = 60
 
-Document excerpt:
-{text_chunk[:2000]}
+@st.cache_resource(show_spinner=False)
+def get_collection():
+    """Shared handle to the papers collection"""
+    # ChromaDB runs as a separate server: chroma run --path ./chroma_db
+    chroma_client = chromadb.HttpClient(
+        host=os.getenv("CHROMA_HOST", "localhost"),
+        port=int(os.getenv("CHROMA_PORT", "8000"))
+    )
+    return chroma_client.get_collection(
+        name=COLLECTION_NAME,
+        embedding_function=None
+    )
+
+@st.cache_data(ttl=300, show_spinner=False)
+def cached_count():
+    """Collection size, refreshed at most every 5 minutes"""
+    return get_collection().count()
+
+collection = get_collection()
+
+# Structured outputs schema: the model must return exactly these string fields
+EXTRACTION_FIELDS = ["methodology", "materials", "findings", "challenges"]
+EXTRACTION_SCHEMA = {
+    "type": "object",
+    "properties": {field: {"type": "string"} for field in EXTRACTION_FIELDS},
+    "required": EXTRACTION_FIELDS,
+    "additionalProperties": False
+}
+# Matches a field once its JSON string value has closed in a partial response
+STREAMED_FIELD_RE = re.compile(
+    r'"(' + "|".join(EXTRACTION_FIELDS) + r')"\s*:\s*"((?:[^"\\]|\\.)*)"'
+)
+BATCH_EXTRACTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "records": {
+            "type": "array",
+            "items": {
+                **EXTRACTION_SCHEMA,
+                "properties": {"excerpt": {"type": "integer"}, **EXTRACTION_SCHEMA["properties"]},
+                "required": ["excerpt", *EXTRACTION_FIELDS]
+            }
+        }
+    },
+    "required": ["records"],
+    "additionalProperties": False
+}
 
-Extract the following if present in the text:
+EXTRACTION_INSTRUCTIONS = """Extract the following if present in the text:
 1. Research methodology/approach
 2. Materials or substances studied
 3. Key findings or outcomes
 4. Challenges, problems, limitations, or failure modes mentioned (look for explicit statements AND implicit challenges being addressed)
 
-Return as JSON with these exact keys:
-{{"methodology": "...", "materials": "...", "findings": "...", "challenges": "..."}}
+Return them in the fields methodology, materials, findings and challenges.
 
 For challenges: Include both explicitly stated problems AND problems that are implicitly being solved by the research (e.g., if text discusses "stabilizing" something, the challenge is instability; if it discusses "improving biocompatibility", the challenge is poor biocompatibility).
 
-If a field is not found, use "Not mentioned" as the value.
+If a field is not found, use "Not mentioned" as the value."""
+
+# Cached results persist to disk, so repeat queries and extractions skip the API
+@st.cache_data(persist="disk", show_spinner=False)
+def embed_queries(queries):
+    """Embed search queries with a single OpenAI request"""
+    response = client.embeddings.create(
+        model=EMBEDDING_MODEL,
+        input=list(queries),
+        dimensions=EMBEDDING_DIMENSIONS
+    )
+    return [item.embedding for item in response.data]
+
+@st.cache_data(persist="disk", show_spinner=False)
+def expand_query(query):
+    """Generate alternative phrasings of a search query"""
+    
+    prompt = f"""Rephrase this search query over scientific papers 3 to 5 different ways, using synonyms and related technical terms. Keep each rephrasing short.
+
+Query: {query}
 """
     
+    response = client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=[{"role": "user", "content": prompt}],
+        response_format={
+            "type": "json_schema",
+            "json_schema": {"name": "expansion", "schema": EXPANSION_SCHEMA, "strict": True}
+        },
+        temperature=0,
+        max_tokens=200
+    )
+    
+    return json.loads(response.choices[0].message.content)["queries"][:5]
+
+def fuse_results(results, n_results):
+    """Merge per-query Chroma results with reciprocal rank fusion"""
+    scores = {}
+    hits = {}
+    
+    for ids, docs, metadatas, distances in zip(
+        results['ids'], results['documents'], results['metadatas'], results['distances']
+    ):
+        for rank, (doc_id, doc, metadata, distance) in enumerate(zip(ids, docs, metadatas, distances)):
+            scores[doc_id] = scores.get(doc_id, 0) + 1 / (RRF_K + rank + 1)
+            # Show each chunk with its closest distance to any of the queries
+            if doc_id not in hits or distance < hits[doc_id][2]:
+                hits[doc_id] = (doc, metadata, distance)
+    
+    ranked = sorted(scores, key=scores.get, reverse=True)[:n_results]
+    return [hits[doc_id] for doc_id in ranked]
+
+def search(query, n_results, expand=False):
+    """Semantic search, optionally over several phrasings in one Chroma call"""
+    queries = [query]
+    if expand:
+        try:
+            queries += expand_query(query)
+        except Exception as e:
+            st.warning(f"Query expansion failed, searching the original query only: {e}")
+    
+    results = collection.query(
+        query_embeddings=embed_queries(queries),
+        n_results=n_results
+    )
+    return fuse_results(results, n_results)
+
+def extraction_request(text_chunk, query):
+    """Chat completion arguments for extracting one excerpt's fields"""
+    
+    prompt = f"""You are analyzing a scientific research document excerpt.
+
+Query: {query}
+
+Document excerpt:
+{text_chunk[:EXCERPT_MAX_CHARS]}
+
+{EXTRACTION_INSTRUCTIONS}
+"""
+    
+    return dict(
+        model="gpt-4o-mini",  # Cheap and fast
+        messages=[{"role": "user", "content": prompt}],
+        response_format={
+            "type": "json_schema",
+            "json_schema": {"name": "extraction", "schema": EXTRACTION_SCHEMA, "strict": True}
+        },
+        temperature=0,
+        max_tokens=500
+    )
+
+@st.cache_data(persist="disk", show_spinner=False)
+def cached_extraction(text_chunk, query, _on_miss=None):
+    """Disk-cached structured fields for an excerpt and query; failures raise and are not cached
+    
+    On a cache hit the stored fields are returned and nothing else runs. On a miss:
+    - with no _on_miss, GPT extracts the fields and the result is cached
+    - with _on_miss (left out of the cache key), its return value is cached instead;
+      probe_cached_extraction and store_extraction use this to read and write the cache
+    """
+    if _on_miss is not None:
+        return _on_miss()
+    
+    response = client.chat.completions.create(**extraction_request(text_chunk, query))
+    return json.loads(response.choices[0].message.content)
+
+class NotCached(Exception):
+    """Raised by raise_not_cached to abort a cache lookup on a miss"""
+
+def raise_not_cached():
+    """_on_miss callback that turns a cache miss into NotCached instead of an API call"""
+    raise NotCached
+
+def probe_cached_extraction(text_chunk, query):
+    """Cached fields for an excerpt and query, or None, without calling the API"""
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",  # Cheap and fast
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0,
-            max_tokens=500
-        )
-        
-        result = response.choices[0].message.content
-        # Clean markdown if present
-        if "```json" in result:
-            result = result.split("```json")[1].split("```")[0]
+        return cached_extraction(text_chunk, query, _on_miss=raise_not_cached)
+    
+    except NotCached:
+        return None
+
+def store_extraction(text_chunk, query, structured):
+    """Write fields extracted outside cached_extraction (e.g. streamed) into its cache"""
+    cached_extraction(text_chunk, query, _on_miss=lambda: structured)
+
+def stream_structured_data(text_chunk, query):
+    """Yield the fields completed so far as the response streams, then the full result"""
+    stream = client.chat.completions.create(**extraction_request(text_chunk, query), stream=True)
+    
+    content = ""
+    completed = 0
+    for event in stream:
+        if not event.choices or not event.choices[0].delta.content:
+            continue
+        content += event.choices[0].delta.content
         
-        return json.loads(result)
+        fields = {
+            match.group(1): json.loads(f'"{match.group(2)}"')
+            for match in STREAMED_FIELD_RE.finditer(content)
+        }
+        if len(fields) > completed:
+            completed = len(fields)
+            yield fields
+    
+    yield json.loads(content)
+
+def extract_structured_data(text_chunk, query):
+    """Extract structured fields, returning the error message on failure"""
+    try:
+        return cached_extraction(text_chunk, query)
     
     except Exception as e:
         return {"error": str(e)}
 
+def extract_structured_data_streaming(text_chunk, query, placeholder):
+    """Extract structured fields into the placeholder, streaming only on a cache miss"""
+    structured = probe_cached_extraction(text_chunk, query)
+    
+    if structured is None:
+        structured = stream_structured_data_into(text_chunk, query, placeholder)
+        if "error" not in structured:
+            # Cache the streamed result for later clicks and sessions
+            store_extraction(text_chunk, query, structured)
+    
+    with placeholder.container():
+        show_structured_data(structured)
+    
+    return structured
+
+def stream_structured_data_into(text_chunk, query, placeholder):
+    """Render each extracted field into the placeholder as it streams in"""
+    pending = {field: "…" for field in EXTRACTION_FIELDS}
+    structured = {}
+    
+    try:
+        with placeholder.container():
+            show_structured_data(pending)
+        
+        for structured in stream_structured_data(text_chunk, query):
+            with placeholder.container():
+                show_structured_data({**pending, **structured})
+    
+    except Exception as e:
+        structured = {"error": str(e)}
+        with placeholder.container():
+            show_structured_data(structured)
+    
+    return structured
+
+@st.cache_data(persist="disk", show_spinner=False)
+def fetch_structured_data_batch(chunks, query):
+    """Extract structured fields for several excerpts in one GPT call"""
+    
+    excerpts = "\n\n".join(
+        f'<excerpt id="{excerpt_id}">\n{chunk[:EXCERPT_MAX_CHARS]}\n</excerpt>'
+        for excerpt_id, chunk in enumerate(chunks, start=1)
+    )
+    
+    prompt = f"""You are analyzing {len(chunks)} scientific research document excerpts.
+
+Query: {query}
+
+Document excerpts:
+{excerpts}
+
+{EXTRACTION_INSTRUCTIONS}
+
+Do this for each excerpt separately and return one record per excerpt, with the excerpt's id in the excerpt field.
+"""
+    
+    response = client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=[{"role": "user", "content": prompt}],
+        response_format={
+            "type": "json_schema",
+            "json_schema": {"name": "batch_extraction", "schema": BATCH_EXTRACTION_SCHEMA, "strict": True}
+        },
+        temperature=0,
+        max_tokens=500 * len(chunks)
+    )
+    
+    records = {
+        record.pop("excerpt"): record
+        for record in json.loads(response.choices[0].message.content)["records"]
+    }
+    return [
+        records.get(excerpt_id, {"error": "No fields returned for this excerpt"})
+        for excerpt_id in range(1, len(chunks) + 1)
+    ]
+
+def extract_structured_data_batch(chunks, query):
+    """Extract structured fields for each chunk, in order, with one API call"""
+    try:
+        return fetch_structured_data_batch(chunks, query)
+    
+    except Exception as e:
+        return [{"error": str(e)} for _ in chunks]
+
+def show_structured_data(structured):
+    """Render extracted fields, or the extraction error"""
+    if "error" not in structured:
+        st.markdown("**Extracted Fields:**")
+        
+        col1, col2 = st.columns(2)
+        with col1:
+            st.markdown("**Methodology:**")
+            st.info(structured.get('methodology', 'N/A'))
+            
+            st.markdown("**Materials:**")
+            st.info(structured.get('materials', 'N/A'))
+        
+        with col2:
+            st.markdown("**Findings:**")
+            st.info(structured.get('findings', 'N/A'))
+            
+            st.markdown("**Challenges:**")
+            st.warning(structured.get('challenges', 'N/A'))
+    else:
+        st.error(f"Extraction failed: {structured['error']}")
+
 # Page config
 st.set_page_config(
     page_title="Scientific Knowledge Search",
@@ -83,7 +373,7 @@ Search by concept, not just keywords.
 # Sidebar stats
 with st.sidebar:
     st.header("📊 Corpus Stats")
-    total_docs = collection.count()
+    total_docs = cached_count()
     st.metric("Total Chunks", f"{total_docs:,}")
     st.metric("Source PDFs", "~30")
     
@@ -93,6 +383,16 @@ with st.sidebar:
     st.code("wet spinning failure modes")
     st.code("polymer degradation mechanisms")
     st.code("biocompatibility testing methods")
+    
+    st.markdown("---")
+    expand_queries = st.checkbox(
+        "Expand query with rephrasings",
+        help="Also search 3-5 GPT rephrasings of the query and merge the results"
+    )
+    isolated_extraction = st.checkbox(
+        "Extract each result with its own prompt",
+        help="Extract All sends one GPT request per result, in parallel, instead of one combined request"
+    )
 
 # Search interface
 query = st.text_input(
@@ -105,19 +405,31 @@ num_results = st.slider("Number of results", 3, 10, 5)
 if query:
     with st.spinner("Searching..."):
         # Semantic search
-        results = collection.query(
-            query_texts=[query],
-            n_results=num_results
-        )
+        hits = search(query, num_results, expand=expand_queries)
+        docs = [doc for doc, _, _ in hits]
+        
+        st.success(f"Found {len(hits)} results")
+        
+        # Extractions persist across reruns, keyed by (query, chunk)
+        extractions = st.session_state.setdefault("extractions", {})
         
-        st.success(f"Found {len(results['documents'][0])} results")
+        # Nothing to extract when the search returns no hits
+        if docs and st.button("🔬 Extract All Results", key="extract_all"):
+            with st.spinner("Extracting all results..."):
+                if isolated_extraction:
+                    workers = min(len(docs), EXTRACTION_WORKERS)
+                    with ThreadPoolExecutor(max_workers=workers) as executor:
+                        records = list(executor.map(
+                            lambda doc: extract_structured_data(doc, query),
+                            docs
+                        ))
+                else:
+                    records = extract_structured_data_batch(docs, query)
+                for doc, structured in zip(docs, records):
+                    extractions[(query, doc)] = structured
         
         # Display results
-        for idx, (doc, metadata, distance) in enumerate(zip(
-            results['documents'][0],
-            results['metadatas'][0],
-            results['distances'][0]
-        )):
+        for idx, (doc, metadata, distance) in enumerate(hits):
             with st.expander(f"**Result {idx+1}** - {metadata['source']} (Page {metadata['page']})", expanded=(idx==0)):
                 # Relevance score
                 relevance = 1 - distance  # Convert distance to similarity
@@ -154,29 +466,17 @@ if query:
                 
                 # Extraction button
                 st.markdown("---")
-                if st.button(f"🔬 Extract Structured Data", key=f"extract_{idx}"):
-                    with st.spinner("Extracting..."):
-                        structured = extract_structured_data(doc, query)
-                        
-                        if "error" not in structured:
-                            st.markdown("**Extracted Fields:**")
-                            
-                            col1, col2 = st.columns(2)
-                            with col1:
-                                st.markdown("**Methodology:**")
-                                st.info(structured.get('methodology', 'N/A'))
-                                
-                                st.markdown("**Materials:**")
-                                st.info(structured.get('materials', 'N/A'))
-                            
-                            with col2:
-                                st.markdown("**Findings:**")
-                                st.info(structured.get('findings', 'N/A'))
-                                
-                                st.markdown("**Challenges:**")
-                                st.warning(structured.get('challenges', 'N/A'))
-                        else:
-                            st.error(f"Extraction failed: {structured['error']}")
+                stored = extractions.get((query, doc))
+                if stored is not None and "error" not in stored:
+                    show_structured_data(stored)
+                
+                elif st.button(f"🔬 Extract Structured Data", key=f"extract_{idx}"):
+                    # Fields render as they stream in, so there's no spinner
+                    extractions[(query, doc)] = extract_structured_data_streaming(doc, query, st.empty())
+                
+                elif stored is not None:
+                    # Show the earlier failure; the button above retries it
+                    show_structured_data(stored)
 
 # Footer
 st.markdown("---")
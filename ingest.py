@@ -1,9 +1,18 @@
 import os
+import re
+import hashlib
+import queue
+import threading
+from collections import deque
+from itertools import compress
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import fitz  # pymupdf
+import numpy as np
+import tiktoken
+from datasketch import MinHash, MinHashLSH
 from pathlib import Path
 from openai import OpenAI
 import chromadb
-from chromadb.utils import embedding_functions
 from dotenv import load_dotenv
 import json
 
@@ -12,18 +21,43 @@ load_dotenv()
 # Initialize OpenAI
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
-# Initialize ChromaDB
-chroma_client = chromadb.PersistentClient(path="./chroma_db")
-
-# Create collection with OpenAI embeddings
-openai_ef = embedding_functions.OpenAIEmbeddingFunction(
-    api_key=os.getenv("OPENAI_API_KEY"),
-    model_name="text-embedding-3-small"
+# ChromaDB runs as a separate server: chroma run --path ./chroma_db
+chroma_client = chromadb.HttpClient(
+    host=os.getenv("CHROMA_HOST", "localhost"),
+    port=int(os.getenv("CHROMA_PORT", "8000"))
 )
 
+# Embeddings are computed here and passed to Chroma explicitly
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 512  # Shortened from the model's native 1536
+# Vectors of different sizes can't share a collection, so the name carries the size
+COLLECTION_NAME = f"scientific_papers_{EMBEDDING_DIMENSIONS}"
+EMBED_BATCH_SIZE = 256  # Up to ~205k tokens, under OpenAI's 300k tokens per request
+EMBED_WORKERS = 8  # Concurrent embedding requests
+EMBED_MAX_RETRIES = 6  # Retries with exponential backoff on rate limits
+CHUNK_QUEUE_SIZE = 4096  # Max chunks buffered between extraction and embedding
+
+# Chunks are sized in embedding-model tokens rather than characters
+ENCODING = tiktoken.encoding_for_model(EMBEDDING_MODEL)
+CHUNK_TOKENS = 800
+CHUNK_OVERLAP_TOKENS = 100
+
+# Precompiled lookups for the chunk quality filter
+INDICATOR_RE = re.compile(r"\[|vol\.|pp\.|no\.|doi:")
+NONDIGIT_DEL = bytes(range(48, 58))  # ASCII '0'-'9', deleted to count digits
+
+# Near-duplicate detection: MinHash over word shingles, indexed with LSH
+DEDUP_THRESHOLD = 0.85  # Estimated Jaccard similarity treated as a duplicate
+MINHASH_PERMUTATIONS = 64
+SHINGLE_SIZE = 5  # Words per shingle
+
+# Plain-text extraction flags: no image or font-detail processing
+TEXT_FLAGS = fitz.TEXT_PRESERVE_LIGATURES | fitz.TEXT_PRESERVE_WHITESPACE | fitz.TEXT_MEDIABOX_CLIP
+
 collection = chroma_client.get_or_create_collection(
-    name="scientific_papers",
-    embedding_function=openai_ef
+    name=COLLECTION_NAME,
+    configuration={"hnsw": {"space": "cosine"}},  # app.py reports 1 - distance as relevance
+    embedding_function=None
 )
 
 def extract_text_from_pdf(pdf_path):
@@ -32,7 +66,11 @@ def extract_text_from_pdf(pdf_path):
     pages_text = []
     
     for page_num, page in enumerate(doc, start=1):
-        text = page.get_text()
+        # Build the text page once with minimal flags and read plain text from it
+        textpage = page.get_textpage(flags=TEXT_FLAGS)
+        text = textpage.extractText()
+        textpage = None  # Free the text page before moving to the next page
+        
         if text.strip():  # Only include pages with text
             pages_text.append({
                 'page_num': page_num,
@@ -42,18 +80,33 @@ def extract_text_from_pdf(pdf_path):
     doc.close()
     return pages_text
 
-def chunk_text(text, chunk_size=1000, overlap=200):
-    """Split text into overlapping chunks"""
-    chunks = []
-    start = 0
+def chunk_offsets(length, chunk_size=CHUNK_TOKENS, overlap=CHUNK_OVERLAP_TOKENS):
+    """Start offsets of overlapping chunks over a sequence of the given length"""
+    if not length:
+        return np.array([], dtype=np.int64)
+    
+    # Stop before a tail that would fall entirely inside the previous chunk's overlap
+    last_start = max(length - overlap, 1)
+    return np.arange(0, last_start, chunk_size - overlap)
+
+def chunk_pages(pages, chunk_size=CHUNK_TOKENS, overlap=CHUNK_OVERLAP_TOKENS):
+    """Chunk a PDF's pages as one text, tagging each chunk with its starting page"""
+    full_text = "\n".join(page_data['text'] for page_data in pages)
+    page_starts = np.cumsum([0] + [len(page_data['text']) + 1 for page_data in pages[:-1]])
     
-    while start < len(text):
-        end = start + chunk_size
-        chunk = text[start:end]
-        chunks.append(chunk)
-        start = end - overlap
+    # PDFs can contain special-token text like <|endoftext|>; encode it as plain text
+    tokens = ENCODING.encode(full_text, disallowed_special=())
+    _, token_chars = ENCODING.decode_with_offsets(tokens)
     
-    return chunks
+    # Map each chunk's first token back to a character offset, then to its page
+    starts = chunk_offsets(len(tokens), chunk_size, overlap)
+    start_chars = np.asarray(token_chars, dtype=np.int64)[starts]
+    page_indices = np.searchsorted(page_starts, start_chars, side='right') - 1
+    
+    return [
+        (pages[page_idx]['page_num'], ENCODING.decode(tokens[start:start + chunk_size]))
+        for start, page_idx in zip(starts.tolist(), page_indices.tolist())
+    ]
 
 def is_useful_chunk(text):
     """Filter out references and other low-quality chunks"""
@@ -62,13 +115,7 @@ def is_useful_chunk(text):
         return False
     
     # Skip if mostly citations (lots of brackets, volumes, pages)
-    citation_indicators = (
-        text.count('[') + 
-        text.count('vol.') + 
-        text.count('pp.') +
-        text.count('no.') +
-        text.count('doi:')
-    )
+    citation_indicators = len(INDICATOR_RE.findall(text))
     
     # If more than 5 citation indicators per 500 chars, likely a reference section
     citation_density = citation_indicators / (len(text) / 500)
@@ -80,80 +127,164 @@ def is_useful_chunk(text):
         return False
     
     # Skip if too many numbers (likely tables of data without context)
-    digit_count = sum(c.isdigit() for c in text)
+    encoded = text.encode("utf-8", "ignore")
+    digit_count = len(encoded) - len(encoded.translate(None, NONDIGIT_DEL))
     if digit_count / len(text) > 0.3:  # >30% digits
         return False
     
     return True
 
-def ingest_pdfs(pdf_dir="data/pdfs"):
-    """Ingest all PDFs into ChromaDB"""
-    pdf_dir = Path(pdf_dir)
-    pdf_files = list(pdf_dir.glob("*.pdf"))
+def chunk_minhash(text):
+    """MinHash signature of a chunk's word shingles"""
+    words = text.split()
+    shingles = [
+        " ".join(words[i:i + SHINGLE_SIZE]).encode("utf-8")
+        for i in range(max(len(words) - SHINGLE_SIZE + 1, 1))
+    ]
     
-    print(f"Found {len(pdf_files)} PDFs to ingest")
+    minhash = MinHash(num_perm=MINHASH_PERMUTATIONS)
+    minhash.update_batch(shingles)
+    return minhash
+
+def is_duplicate_chunk(doc_id, text, seen_hashes, lsh):
+    """Check a chunk against those already kept, recording it if it's new"""
+    # Exact duplicates: cheap hash lookup before any MinHash work
+    digest = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+    if digest in seen_hashes:
+        return True
+    seen_hashes.add(digest)
     
-    documents = []
-    metadatas = []
-    ids = []
+    minhash = chunk_minhash(text)
+    if lsh.query(minhash):
+        return True
+    lsh.insert(doc_id, minhash)
     
-    total_chunks = 0
-    filtered_chunks = 0
+    return False
+
+def embed_texts(texts):
+    """Embed a batch of texts with a single OpenAI request"""
+    # The OpenAI client retries RateLimitError with exponential backoff
+    response = client.with_options(max_retries=EMBED_MAX_RETRIES).embeddings.create(
+        model=EMBEDDING_MODEL,
+        input=texts,
+        dimensions=EMBEDDING_DIMENSIONS
+    )
+    return [item.embedding for item in response.data]
+
+def produce_chunks(pdf_files, chunk_queue, stats):
+    """Extract, chunk, filter and deduplicate PDFs, feeding kept chunks to the queue"""
+    seen_hashes = set()
+    lsh = MinHashLSH(threshold=DEDUP_THRESHOLD, num_perm=MINHASH_PERMUTATIONS)
     
-    for idx, pdf_path in enumerate(pdf_files):
-        print(f"\nProcessing {idx+1}/{len(pdf_files)}: {pdf_path.name}")
-        
-        try:
-            pages = extract_text_from_pdf(pdf_path)
+    try:
+        # Extract PDFs in parallel worker processes; chunking stays in this thread
+        with ProcessPoolExecutor() as executor:
+            extractions = [executor.submit(extract_text_from_pdf, pdf_path) for pdf_path in pdf_files]
             
-            for page_data in pages:
-                # Chunk the page text
-                chunks = chunk_text(page_data['text'])
+            for idx, (pdf_path, extraction) in enumerate(zip(pdf_files, extractions)):
+                print(f"\nProcessing {idx+1}/{len(pdf_files)}: {pdf_path.name}")
                 
-                for chunk_idx, chunk in enumerate(chunks):
-                    total_chunks += 1
+                try:
+                    pages = extraction.result()
                     
-                    # Filter out low-quality chunks
-                    if not is_useful_chunk(chunk):
-                        filtered_chunks += 1
-                        continue
+                    # Chunk the whole PDF at once; chunks may cross page boundaries
+                    chunks = chunk_pages(pages)
                     
-                    doc_id = f"{pdf_path.stem}_p{page_data['page_num']}_c{chunk_idx}"
+                    # Filter out low-quality chunks in one pass, then queue the survivors
+                    keep = [is_useful_chunk(chunk) for _, chunk in chunks]
+                    stats['total'] += len(chunks)
+                    stats['filtered'] += keep.count(False)
                     
-                    documents.append(chunk)
-                    metadatas.append({
-                        'source': pdf_path.name,
-                        'page': page_data['page_num'],
-                        'chunk': chunk_idx
-                    })
-                    ids.append(doc_id)
-            
-            print(f"  ✓ Extracted {len(pages)} pages")
+                    for chunk_idx, (page_num, chunk) in compress(enumerate(chunks), keep):
+                        doc_id = f"{pdf_path.stem}_p{page_num}_c{chunk_idx}"
+                        
+                        # Skip chunks that repeat one already queued, in this or another PDF
+                        if is_duplicate_chunk(doc_id, chunk, seen_hashes, lsh):
+                            stats['duplicates'] += 1
+                            continue
+                        
+                        stats['kept'] += 1
+                        chunk_queue.put((doc_id, chunk, {
+                            'source': pdf_path.name,
+                            'page': page_num,
+                            'chunk': chunk_idx
+                        }))
+                    
+                    print(f"  ✓ Extracted {len(pages)} pages")
+                    
+                except Exception as e:
+                    print(f"  ✗ Error: {e}")
+                    continue
+    finally:
+        chunk_queue.put(None)  # Sentinel: no more chunks
+
+def batch_chunks(chunk_queue, batch_size):
+    """Yield batches of queued chunks until the sentinel arrives"""
+    batch = []
+    while (item := chunk_queue.get()) is not None:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    
+    if batch:
+        yield batch
+
+def add_batch(batch, embeddings):
+    """Store a batch of chunks once its embedding request completes"""
+    ids, documents, metadatas = zip(*batch)
+    collection.add(
+        documents=list(documents),
+        embeddings=embeddings.result(),
+        metadatas=list(metadatas),
+        ids=list(ids)
+    )
+    print(f"Added batch of {len(batch)} chunks")
+
+def ingest_pdfs(pdf_dir="data/pdfs"):
+    """Ingest all PDFs into ChromaDB"""
+    pdf_dir = Path(pdf_dir)
+    pdf_files = list(pdf_dir.glob("*.pdf"))
+    
+    print(f"Found {len(pdf_files)} PDFs to ingest")
+    
+    # Extraction runs in a producer thread so embedding starts with the first batch
+    chunk_queue = queue.Queue(maxsize=CHUNK_QUEUE_SIZE)
+    stats = {'total': 0, 'filtered': 0, 'duplicates': 0, 'kept': 0}
+    producer = threading.Thread(
+        target=produce_chunks,
+        args=(pdf_files, chunk_queue, stats),
+        daemon=True
+    )
+    producer.start()
+    
+    # Embed batches concurrently; a single writer thread stores them in order,
+    # so Chroma writes overlap embedding and never block dispatching new batches
+    pending = deque()
+    
+    with ThreadPoolExecutor(max_workers=EMBED_WORKERS) as embedder, \
+            ThreadPoolExecutor(max_workers=1) as writer:
+        for batch in batch_chunks(chunk_queue, EMBED_BATCH_SIZE):
+            texts = [chunk for _, chunk, _ in batch]
+            embeddings = embedder.submit(embed_texts, texts)
+            pending.append(writer.submit(add_batch, batch, embeddings))
             
-        except Exception as e:
-            print(f"  ✗ Error: {e}")
-            continue
+            # Cap batches in flight to bound memory; surface write errors early
+            while len(pending) > EMBED_WORKERS or (pending and pending[0].done()):
+                pending.popleft().result()
+        
+        while pending:
+            pending.popleft().result()
+    
+    producer.join()
     
     print(f"\n📊 Filtering stats:")
-    print(f"   Total chunks extracted: {total_chunks}")
-    print(f"   Filtered out (low quality): {filtered_chunks}")
-    print(f"   Kept for embedding: {len(documents)}")
-    
-    # Add to ChromaDB in batches
-    batch_size = 100
-    for i in range(0, len(documents), batch_size):
-        batch_docs = documents[i:i+batch_size]
-        batch_meta = metadatas[i:i+batch_size]
-        batch_ids = ids[i:i+batch_size]
-        
-        collection.add(
-            documents=batch_docs,
-            metadatas=batch_meta,
-            ids=batch_ids
-        )
-        print(f"Added batch {i//batch_size + 1}/{(len(documents)-1)//batch_size + 1}")
-    
-    print(f"\n✓ Ingestion complete! High-quality chunks stored: {len(documents)}")
+    print(f"   Total chunks extracted: {stats['total']}")
+    print(f"   Filtered out (low quality): {stats['filtered']}")
+    print(f"   Skipped (duplicates): {stats['duplicates']}")
+    print(f"   Kept for embedding: {stats['kept']}")
+    
+    print(f"\n✓ Ingestion complete! High-quality chunks stored: {stats['kept']}")
 
 if __name__ == "__main__":
     ingest_pdfs()
\ No newline at end of file